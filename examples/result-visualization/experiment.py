@@ -2,10 +2,24 @@
 
 import os
 import math
-import pylab as pl
+import argparse
+import functools
+import numpy as np
+import matplotlib
+# plots are only saved to files, so do not initialize an interactive backend
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
 #import seaborn as sns
 import json
+import re
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # optional, but parses large results files considerably faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 if os.name == "nt":
     SIMULATOR = "..\\..\\tsch-sim-windows.bat"
@@ -14,16 +28,23 @@ else:
 
 CONFIG_TEMPLATE_NAME = "config.json.tmpl"
 
+# matches a `%KEY%` placeholder in the configuration template
+TEMPLATE_VARIABLE_RE = re.compile(r"%([A-Z_][A-Z0-9_]*)%")
+
+# ignore the global summary information and the results on the root node
+IGNORED_NODES = ("global-stats", "1")
+
 DEFAULT_OPTIONS = {
     "RESULTS_DIR": "results",
+    "SIMULATION_NUM_RUNS": 4,
     "SCHEDULING_ALGORITHM": "Orchestra",
     "TSCH_SCHEDULE_CONF_DEFAULT_LENGTH": 7,
     "ORCHESTRA_UNICAST_PERIOD": 7,
-    "ORCHESTRA_RULES": """[
+    "ORCHESTRA_RULES": [
         "orchestra_rule_eb_per_time_source",
         "orchestra_rule_unicast_per_neighbor_rpl_storing",
         "orchestra_rule_default_common"
-    ]""",
+    ],
     "ORCHESTRA_UNICAST_SENDER_BASED": 0,
 }
 
@@ -36,53 +57,90 @@ class Experiment:
             self.options[key] = options[key]
         self.options["RESULTS_DIR"] = self.results_dir
         self.results = None
+        self.metric_arrays = {}
 
-    def run(self):
+    def run(self, force=False):
         filename = generate_config_file(self.name, self.options)
-        subprocess.call(" ".join([SIMULATOR, filename]), shell=True, stdout=subprocess.DEVNULL)
-
-    def load_results(self):
-        with open(os.path.join(self.results_dir, "stats_merged.json"), "r") as f:
-            self.results = json.load(f)
+        if not force and self.has_results(filename):
+            print("   {}: results up to date, skipping".format(self.name))
+            return
+        print("   {}...".format(self.name))
+        subprocess.call([SIMULATOR, filename], stdout=subprocess.DEVNULL)
+
+    # check whether the results directory has complete results for this configuration file
+    def has_results(self, config_filename):
+        # the simulator copies the configuration file to the results directory when it starts
+        used_config_filename = os.path.join(self.results_dir, os.path.basename(config_filename))
+        stats_filename = os.path.join(self.results_dir, "stats_merged.json")
+        if not os.path.exists(used_config_filename) or not os.path.exists(stats_filename):
+            return False
+        # results of an interrupted simulation are older than its configuration file
+        if os.path.getmtime(stats_filename) < os.path.getmtime(used_config_filename):
+            return False
+        with open(config_filename, "r") as f, open(used_config_filename, "r") as used_f:
+            return f.read() == used_f.read()
+
+    def load_results(self, metrics=None):
+        with open(os.path.join(self.results_dir, "stats_merged.json"), "rb") as f:
+            results = json_loads(f.read())
+        if metrics is not None:
+            # keep only the requested per-node metrics, drop everything else
+            results = {run: {node: {m: node_results[m] for m in metrics if m in node_results}
+                             for node, node_results in run_results.items()}
+                       for run, run_results in results.items()}
+        self.results = results
+        self.metric_arrays = {}
+
+    # get a metric as an array with one row per run and one column per node; missing values are NaN
+    def metric_array(self, metric_name):
+        values = self.metric_arrays.get(metric_name)
+        if values is None:
+            # the results are flattened only once per metric, no matter how many plots use it
+            values = np.array([[node_results[metric_name]
+                                for node, node_results in run_results.items() if node not in IGNORED_NODES]
+                               for run_results in self.results.values()], dtype=float)
+            self.metric_arrays[metric_name] = values
+        return values
+
+# the template is the same for all experiments, so read it only once
+@functools.lru_cache(maxsize=None)
+def load_template(path):
+    with open(path, "r") as f:
+        return f.read()
+
+def format_option(value):
+    # multi-line strings are taken to be already formatted JSON
+    if type(value) is str and '\n' in value:
+        return value
+    return json.dumps(value)
 
 def generate_config_file(name, options):
-    with open(CONFIG_TEMPLATE_NAME, "r") as f:
-        contents = f.read()
-        for key in options:
-            value = options[key]
-            if type(value) is str and '\n' not in value:
-                value = '"{}"'.format(value)
-            else:
-                value = str(value)
-            contents = contents.replace("%{}%".format(key), value)
-        filename = "config-{}.json".format(name)
-        with open(filename, "w") as wf:
-            wf.write(contents)
-        return filename
+    contents = load_template(CONFIG_TEMPLATE_NAME)
+    rendered = {key: format_option(value) for key, value in options.items()}
+    # substitute all placeholders in a single pass; unknown ones are left as they are
+    contents = TEMPLATE_VARIABLE_RE.sub(lambda m: rendered.get(m.group(1), m.group(0)), contents)
+    filename = "config-{}.json".format(name)
+    with open(filename, "w") as wf:
+        wf.write(contents)
+    return filename
+
+# the simulator forks one process per run, so do not start more experiments than there are CPU cores for
+def run_experiments(experiments, force=False):
+    num_runs = max(exp.options["SIMULATION_NUM_RUNS"] for exp in experiments)
+    max_workers = max(1, min(len(experiments), (os.cpu_count() or 1) // num_runs))
+    # the experiments wait on the simulator subprocesses, so threads are sufficient
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda exp: exp.run(force), experiments))
 
 # extract a single metric
 def extract_metric(experiments, arguments):
     metric_name, default_value = arguments
     results = []
     for exp in experiments:
-        exp_results = []
-        for run in exp.results:
-            run_results = exp.results[run]
-            total = 0
-            num_nodes = 0
-            for node in run_results:
-                # ignore the global summary information and gateway results
-                if node in ["global-stats", "1"]:
-                    continue
-                value = run_results[node][metric_name]
-                if value is None:
-                    value = default_value
-                total += value
-                num_nodes += 1
-            # compute the average metric across all nodes
-            avg = total / num_nodes
-            exp_results.append(avg)
-        results.append(exp_results)
+        values = exp.metric_array(metric_name)
+        values = np.where(np.isnan(values), default_value, values)
+        # compute the average metric across all nodes
+        results.append(values.mean(axis=1))
     return results
 
 # extract multiple metrics and interpret them using the function passed in the arguments
@@ -91,33 +149,20 @@ def extract_metrics(experiments, arguments):
     metric1_name, metric2_name, function = arguments
     results = []
     for exp in experiments:
-        exp_results1 = []
-        exp_results2 = []
-        for run in exp.results:
-            run_results = exp.results[run]
-            total1 = 0
-            total2 = 0
-            num_nodes = 0
-            for node in run_results:
-                # ignore the global summary information and the results on the root node
-                if node in ["global-stats", "1"]:
-                    continue
-                total1 += run_results[node][metric1_name]
-                total2 += run_results[node][metric2_name]
-                num_nodes += 1
-            # compute the average metric across all nodes
-            avg1 = total1 / num_nodes
-            avg2 = total2 / num_nodes
-            exp_results1.append(avg1)
-            exp_results2.append(avg2)
-
-        results.append([function(x, y) for x, y in zip(exp_results1, exp_results2)])
+        # compute the average metrics across all nodes
+        avg1 = exp.metric_array(metric1_name).mean(axis=1)
+        avg2 = exp.metric_array(metric2_name).mean(axis=1)
+        # the function is applied to all runs at once
+        results.append(function(avg1, avg2))
     return results
 
+# a single figure is reused for all plots
+fig, ax = plt.subplots(figsize=(7, 4))
+
 def plot(experiments, function, arguments, title):
-    pl.figure(figsize=(7, 4))
-    pl.gca().xaxis.grid(False)
-    pl.gca().yaxis.grid(True)
+    ax.clear()
+    ax.xaxis.grid(False)
+    ax.yaxis.grid(True)
 
     results = function(experiments, arguments)
 
@@ -135,23 +180,28 @@ def plot(experiments, function, arguments, title):
     x = range(len(results))
     min_values_yerr = [mean - mn for mean, mn in zip(mean_values, min_values)]
     max_values_yerr = [mx - mean for mean, mx in zip(mean_values, max_values)]
-    bars = pl.bar(x, mean_values, yerr=[min_values_yerr, max_values_yerr])
+    bars = ax.bar(x, mean_values, yerr=[min_values_yerr, max_values_yerr])
     for b in bars:
         b.set_edgecolor("black")
         b.set_linewidth(1)
-    pl.xticks(x, [exp.name for exp in experiments])
+    ax.set_xticks(x)
+    ax.set_xticklabels([exp.name for exp in experiments])
 
-    pl.ylabel(title)
+    ax.set_ylabel(title)
     # use 0 or `total_min_value` as the lower bound
     if "PDR" in title:
-        pl.ylim(total_min_value, total_max_value)
+        ax.set_ylim(total_min_value, total_max_value)
     else:
-        pl.ylim(0, total_max_value)
+        ax.set_ylim(0, total_max_value)
 
-    pl.savefig("plot {}.pdf".format(title), format="pdf")
-    pl.close()
+    fig.savefig("plot {}.pdf".format(title), format="pdf")
 
 def main():
+    parser = argparse.ArgumentParser(description="Run TSCH-Sim experiments and plot their results")
+    parser.add_argument("--force", action="store_true",
+                        help="rerun the experiments even if their results are up to date")
+    args = parser.parse_args()
+
     # construct experiments
     print("constructing experiments...")
     experiments = []
@@ -173,14 +223,23 @@ def main():
 
     # run the experiments
     print("running experiments...")
-    for exp in experiments:
-        print("   {}...".format(exp.name))
-        exp.run()
+    run_experiments(experiments, args.force)
+
+    # the metrics to plot from the experiments
+    plots = [
+        (extract_metric, ["tsch_join_time_sec", 3600], "TSCH joining time, seconds"),
+        (extract_metric, ["avg_current_joined_uA", 0], "Average current consumption, uA"),
+        (extract_metric, ["radio_duty_cycle_joined", 0], "Radio duty cycle, %"),
+        (extract_metrics, ["app_num_lost", "app_num_endpoint_rx", lambda x, y: 100.0 * (1.0 - x / (x + y))], "Application PDR, %"),
+        (extract_metrics, ["mac_parent_acked", "mac_parent_tx_unicast", lambda x, y: 100.0 * x / y], "Link layer PAR, %"),
+    ]
+    # the metric names are the string arguments of the extract functions
+    metrics = {a for _, arguments, _ in plots for a in arguments if type(a) is str}
 
     # load the experiment results
     print("loading experiment results...")
     for exp in experiments:
-        exp.load_results()
+        exp.load_results(metrics)
 
     # plot various metrics from the experiments
     print("plotting experiment results...")
@@ -188,11 +247,8 @@ def main():
     #sns.set() # use seaborn default style
     #sns.set_style("whitegrid") # alternative style selection
 
-    plot(experiments, extract_metric, ["tsch_join_time_sec", 3600], "TSCH joining time, seconds")
-    plot(experiments, extract_metric, ["avg_current_joined_uA", 0], "Average current consumption, uA")
-    plot(experiments, extract_metric, ["radio_duty_cycle_joined", 0], "Radio duty cycle, %")
-    plot(experiments, extract_metrics, ["app_num_lost", "app_num_endpoint_rx", lambda x, y: 100.0 * (1.0 - x / (x + y))], "Application PDR, %")
-    plot(experiments, extract_metrics, ["mac_parent_acked", "mac_parent_tx_unicast", lambda x, y: 100.0 * x / y], "Link layer PAR, %")
+    for function, arguments, title in plots:
+        plot(experiments, function, arguments, title)
 
 if __name__ == "__main__":
     main()